@@ -23,7 +23,8 @@ from .. import parser
 from .. import checker
 from ..layout import convex_layout
 from ..graph import Graph
-from ..state import Part, ProofStepPart, State, RewritePart, GraphPart, ImportPart, TwoGraphPart
+from ..parts import Part, ProofStepPart, RewritePart, GraphPart, ImportPart, TwoGraphPart
+from ..state import State
 from .. import proofstate
 
 from . import mainwindow
@@ -33,7 +34,6 @@ from .proofstatemodel import ProofStateModel
 from .graphview import GraphView
 from .codeview import CodeView
 from .document import ChypDocument
-# from .. import state
 
 class Editor(QWidget):
     def __init__(self) -> None:
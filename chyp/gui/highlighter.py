@@ -18,7 +18,8 @@ import re
 from PySide6.QtGui import QColor, QSyntaxHighlighter, QTextDocument
 
 from .colors import current_theme
-from ..state import Part, State
+from ..parts import Part
+from ..state import State
 
 # palette from: https://github.com/catppuccin/catppuccin
 theme = current_theme()
@@ -15,7 +15,9 @@
 """Matching of a graph into another."""
 
 from __future__ import annotations
-from typing import Iterator, Iterable
+from collections import Counter
+from itertools import chain
+from typing import Any, Iterator, Iterable
 from .graph import Graph
 from .rule import Rule
 
@@ -23,18 +25,49 @@ DEBUG_MATCH = False
 
 
 def match_log(s: str) -> None:
-    """Used for debugging the matcher"""
+    """Used for debugging the matcher
+
+    Call sites are guarded by `if DEBUG_MATCH:` as well, so that the message
+    is not even formatted unless debugging is switched on.
+    """
     if DEBUG_MATCH:
         print(s)
 
 
 class Match:
+    # A search copies one Match per result, so avoid a __dict__ per instance.
+    __slots__ = ('domain', 'codomain', 'vertex_map', 'vertex_image',
+                 'vertex_preimage', 'edge_map', 'edge_image', 'trail',
+                 'domain_boundary', 'codomain_boundary', 'domain_size',
+                 'vertex_candidates', 'codomain_vertex_groups',
+                 'edge_candidates', 'vertex_order', 'successor_cache',
+                 'injective')
+
     domain: Graph
     codomain: Graph
     vertex_map: dict[int, int]
     vertex_image: set[int]
+    # The domain vertices mapped to each vertex in `vertex_image`, kept up
+    # to date by `add_vertex`, which anything adding to `vertex_image` should
+    # use, and by `undo`.
+    vertex_preimage: dict[int, list[int]]
     edge_map: dict[int, int]
     edge_image: set[int]
+    trail: list[tuple[str, int]]
+    domain_boundary: set[int]
+    codomain_boundary: set[int]
+    domain_size: int
+    vertex_candidates: dict[int, list[int]]
+    # Codomain vertices grouped by (vtype, size), and interior codomain
+    # vertices grouped by (vtype, size, in-degree, out-degree).
+    codomain_vertex_groups: dict[tuple[Any, int]
+                                 | tuple[Any, int, int, int], list[int]]
+    edge_candidates: dict[tuple[Any, int, int], set[int]]
+    vertex_order: list[int]
+    successor_cache: dict[frozenset[int], set[int]]
+    # Whether to reject non-injective maps on boundary vertices as soon as
+    # they are added, as convex matches must be injective.
+    injective: bool
 
     def __init__(self,
                  domain: Graph | None = None,
@@ -45,15 +78,43 @@ class Match:
             self.codomain = match.codomain
             self.vertex_map = match.vertex_map.copy()
             self.vertex_image = match.vertex_image.copy()
+            self.vertex_preimage = {v: vs.copy() for v, vs
+                                    in match.vertex_preimage.items()}
             self.edge_map = match.edge_map.copy()
             self.edge_image = match.edge_image.copy()
+            self.trail = []
+            self.domain_boundary = match.domain_boundary
+            self.codomain_boundary = match.codomain_boundary
+            self.domain_size = match.domain_size
+            self.vertex_candidates = match.vertex_candidates
+            self.codomain_vertex_groups = match.codomain_vertex_groups
+            self.edge_candidates = match.edge_candidates
+            self.vertex_order = match.vertex_order
+            self.successor_cache = match.successor_cache
+            self.injective = match.injective
         elif domain and codomain:
             self.domain = domain
             self.codomain = codomain
             self.vertex_map = dict()
             self.vertex_image = set()
+            self.vertex_preimage = dict()
             self.edge_map = dict()
             self.edge_image = set()
+            self.trail = []
+            # The boundary vertices of each graph, which the matcher looks up
+            # far more often than the graphs change.
+            self.domain_boundary = set(domain.inputs())
+            self.domain_boundary.update(domain.outputs())
+            self.codomain_boundary = set(codomain.inputs())
+            self.codomain_boundary.update(codomain.outputs())
+            # The number of vertices and edges a total match maps.
+            self.domain_size = domain.num_vertices() + domain.num_edges()
+            self.vertex_candidates = dict()
+            self.codomain_vertex_groups = dict()
+            self.edge_candidates = dict()
+            self.vertex_order = []
+            self.successor_cache = dict()
+            self.injective = False
         else:
             raise ValueError("Must provide either a match or a pair of graphs")
 
@@ -64,6 +125,148 @@ class Match:
     def copy(self) -> Match:
         return Match(match=self)
 
+    def add_vertex(self, domain_vertex: int, codomain_vertex: int) -> None:
+        """Map `domain_vertex` to `codomain_vertex`, without any checks.
+
+        This keeps `vertex_image` and `vertex_preimage` in step with
+        `vertex_map`, but does not record the map for :py:meth:`undo`.
+        """
+        self.vertex_map[domain_vertex] = codomain_vertex
+        self.vertex_image.add(codomain_vertex)
+        self.vertex_preimage.setdefault(codomain_vertex,
+                                        []).append(domain_vertex)
+
+    def checkpoint(self) -> int:
+        """Return a marker for the current state of the match.
+
+        Passing the marker to :py:meth:`undo` removes everything added to
+        the match since the marker was taken.
+        """
+        return len(self.trail)
+
+    def undo(self, checkpoint: int) -> None:
+        """Roll the match back to the state it had at `checkpoint`."""
+        trail = self.trail
+        vertex_map = self.vertex_map
+        vertex_preimage = self.vertex_preimage
+        while len(trail) > checkpoint:
+            kind, x = trail.pop()
+            if kind == 'v':
+                codomain_vertex = vertex_map.pop(x)
+                preimage = vertex_preimage[codomain_vertex]
+                preimage.pop()
+                if not preimage:
+                    del vertex_preimage[codomain_vertex]
+                    self.vertex_image.remove(codomain_vertex)
+            else:
+                self.edge_image.remove(self.edge_map.pop(x))
+
+    def candidate_vertices(self, domain_vertex: int) -> list[int]:
+        """Return the codomain vertices `domain_vertex` may be mapped to.
+
+        This leaves out codomain vertices that :py:meth:`try_add_vertex` would
+        reject whatever the rest of the match is, because their type, size,
+        boundary or degree is wrong. Since this only depends on the graphs, it
+        is computed once and shared with copies of this match. The codomain
+        vertices are grouped by type, size and degree the first time this is
+        called, so that each domain vertex only looks at its own group.
+        """
+        candidates = self.vertex_candidates.get(domain_vertex)
+        if candidates is not None:
+            return candidates
+
+        groups = self.codomain_vertex_groups
+        if not groups:
+            for codomain_vertex, codomain_data in self.codomain.vdata.items():
+                key = (codomain_data.vtype, codomain_data.size)
+                groups.setdefault(key, []).append(codomain_vertex)
+                if codomain_vertex not in self.codomain_boundary:
+                    degree_key = key + (len(codomain_data.in_edges),
+                                        len(codomain_data.out_edges))
+                    groups.setdefault(degree_key,
+                                      []).append(codomain_vertex)
+
+        vertex_data = self.domain.vertex_data(domain_vertex)
+        in_degree = len(vertex_data.in_edges)
+        out_degree = len(vertex_data.out_edges)
+        if domain_vertex in self.domain_boundary:
+            # Boundary vertices only need room for their adjacent edges.
+            codomain_vdata = self.codomain.vdata
+            group = groups.get((vertex_data.vtype, vertex_data.size), [])
+            candidates = [v for v in group
+                          if len(codomain_vdata[v].in_edges) >= in_degree
+                          and len(codomain_vdata[v].out_edges) >= out_degree]
+        else:
+            # Interior vertices must satisfy the gluing conditions, which
+            # makes them exactly the interior vertices with the same degrees.
+            candidates = groups.get((vertex_data.vtype, vertex_data.size,
+                                     in_degree, out_degree), [])
+        self.vertex_candidates[domain_vertex] = candidates
+        return candidates
+
+    def candidate_edges(self, domain_edge: int) -> set[int]:
+        """Return the codomain edges `domain_edge` may be mapped to.
+
+        These are the codomain edges with the same value and the same number
+        of sources and targets. The codomain edges are grouped this way the
+        first time this is called, and shared with copies of this match.
+        """
+        if not self.edge_candidates:
+            for edge in self.codomain.edges():
+                edge_data = self.codomain.edge_data(edge)
+                key = (edge_data.value, len(edge_data.s), len(edge_data.t))
+                self.edge_candidates.setdefault(key, set()).add(edge)
+        edge_data = self.domain.edge_data(domain_edge)
+        return self.edge_candidates.get(
+            (edge_data.value, len(edge_data.s), len(edge_data.t)), set())
+
+    def has_room(self) -> bool:
+        """Return whether the codomain is big enough for a total match.
+
+        The edge map is injective, and so is the vertex map on interior
+        vertices, whose images are interior and never shared. So a total match
+        can only exist if the codomain has at least as many edges of each
+        value and arity, and interior vertices of each type and size, as the
+        domain does. This is cheap to check before starting a search.
+        """
+        def edge_counts(g: Graph) -> Counter[tuple[Any, int, int]]:
+            return Counter((ed.value, len(ed.s), len(ed.t))
+                           for ed in g.edata.values())
+
+        def interior_counts(g: Graph,
+                            boundary: set[int]) -> Counter[tuple[Any, int]]:
+            return Counter((vd.vtype, vd.size) for v, vd in g.vdata.items()
+                           if v not in boundary)
+
+        codomain_edges = edge_counts(self.codomain)
+        for key, n in edge_counts(self.domain).items():
+            if codomain_edges[key] < n:
+                return False
+        codomain_vertices = interior_counts(self.codomain,
+                                            self.codomain_boundary)
+        for vkey, count in interior_counts(self.domain,
+                                           self.domain_boundary).items():
+            if codomain_vertices[vkey] < count:
+                return False
+        return True
+
+    def domain_vertex_order(self) -> list[int]:
+        """Return the domain vertices in the order they should be matched.
+
+        Vertices with the fewest candidates come first, breaking ties by
+        putting vertices with more adjacent edges first, so that the search
+        branches as little as possible near its root. Like the candidates,
+        the order is computed once and shared with copies of this match.
+        """
+        if not self.vertex_order:
+            def constraint(v: int) -> tuple[int, int]:
+                return (len(self.candidate_vertices(v)),
+                        -len(self.domain.in_edges(v))
+                        - len(self.domain.out_edges(v)))
+            self.vertex_order.extend(
+                sorted(self.domain.vertices(), key=constraint))
+        return self.vertex_order
+
     def try_add_vertex(self, domain_vertex: int,
                        codomain_vertex: int) -> bool:
         """Try to map `domain_vertex` to `codomain_vertex`.
@@ -74,85 +277,104 @@ class Match:
         Returns:
             `True` if either a consistent map from `domain_vertex` to
             `codomain_vertex` already exists or the new map is consistent
-            and satifies the gluing conditions, otherwise `False`.
+            and satifies the gluing conditions, otherwise `False`. On
+            failure, the match may have been partially extended and should
+            be rolled back with :py:meth:`undo`.
         """
-        match_log(f'Trying to add vertex {domain_vertex} '
-                  + f'-> {codomain_vertex} to match:')
-        match_log(str(self))
+        if DEBUG_MATCH:
+            match_log(f'Trying to add vertex {domain_vertex} '
+                      + f'-> {codomain_vertex} to match:')
+            match_log(str(self))
 
         # If the vertex is already mapped, only check the new mapping is
         # consistent with the current match.
-        if domain_vertex in self.vertex_map:
-            match_log('Vertex already mapped to '
-                      + f'{self.vertex_map[domain_vertex]}.')
-            return self.vertex_map[domain_vertex] == codomain_vertex
+        vertex_map = self.vertex_map
+        if domain_vertex in vertex_map:
+            if DEBUG_MATCH:
+                match_log('Vertex already mapped to '
+                          + f'{vertex_map[domain_vertex]}.')
+            return vertex_map[domain_vertex] == codomain_vertex
 
         # Ensure the mapping preserves vertex type.
-        domain_vertex_type = self.domain.vertex_data(domain_vertex).vtype
-        codomain_vertex_type = self.codomain.vertex_data(codomain_vertex).vtype
-        if domain_vertex_type != codomain_vertex_type:
-            match_log(f'Vertex failed: vtypes {domain_vertex_type} != '
-                      + f'{codomain_vertex_type} do not match.')
+        domain_data = self.domain.vdata[domain_vertex]
+        codomain_data = self.codomain.vdata[codomain_vertex]
+        if domain_data.vtype != codomain_data.vtype:
+            if DEBUG_MATCH:
+                match_log(f'Vertex failed: vtypes {domain_data.vtype} != '
+                          + f'{codomain_data.vtype} do not match.')
             return False
         # Ensure the mapping preserves vertex size.
-        domain_vertex_size = self.domain.vertex_data(domain_vertex).size
-        codomain_vertex_size = self.codomain.vertex_data(codomain_vertex).size
-        if domain_vertex_size != codomain_vertex_size:
-            match_log(f'Vertex failed: sizes {domain_vertex_size} != '
-                      + f'{codomain_vertex_size} do not match.')
+        if domain_data.size != codomain_data.size:
+            if DEBUG_MATCH:
+                match_log(f'Vertex failed: sizes {domain_data.size} != '
+                          + f'{codomain_data.size} do not match.')
             return False
 
         # Ensure non-boundary vertices in the domain are not mapped to
         # boundary vertices in the codomain.
-        if (self.codomain.is_boundary(codomain_vertex)
-           and not self.domain.is_boundary(domain_vertex)):
-            match_log('Vertex failed: codomain vertex is boundary but '
-                      + 'domain vertex is not.')
+        domain_is_boundary = domain_vertex in self.domain_boundary
+        if (codomain_vertex in self.codomain_boundary
+           and not domain_is_boundary):
+            if DEBUG_MATCH:
+                match_log('Vertex failed: codomain vertex is boundary but '
+                          + 'domain vertex is not.')
             return False
 
         # Matches must be injective everywhere except the boundary, so if the
         # domain vertex is already mapped to another codomain vertex, check
         # whether this non-injective mapping is permitted.
         if codomain_vertex in self.vertex_image:
+            # If only injective matches are wanted, no vertex can be used
+            # in a non-injective mapping.
+            if self.injective:
+                if DEBUG_MATCH:
+                    match_log('Vertex failed: non-injective map when an '
+                              + 'injective match is required.')
+                return False
             # If the domain vertex we are trying to add is not a boundary
             # vertex, it cannot be used in a non-injective mapping.
-            if not self.domain.is_boundary(domain_vertex):
-                match_log('Vertex failed: non-injective on interior vertex.')
+            if not domain_is_boundary:
+                if DEBUG_MATCH:
+                    match_log(
+                        'Vertex failed: non-injective on interior vertex.')
                 return False
             # If any vertices already mapped to the codomain vertex, they must
             # also be boundary vertices for an allowed non-injective mapping.
-            for mapped_vertex, image_vertex in self.vertex_map.items():
-                if (image_vertex == codomain_vertex
-                   and not self.domain.is_boundary(mapped_vertex)):
-                    match_log(
-                        'Vertex failed: non-injective on interior vertex.')
+            domain_boundary = self.domain_boundary
+            for mapped_vertex in self.vertex_preimage.get(codomain_vertex,
+                                                          ()):
+                if mapped_vertex not in domain_boundary:
+                    if DEBUG_MATCH:
+                        match_log(
+                            'Vertex failed: non-injective on interior vertex.')
                     return False
 
         # If a new and consistent map is found,
         # add it to the vertex map of this match.
-        self.vertex_map[domain_vertex] = codomain_vertex
-        self.vertex_image.add(codomain_vertex)
+        self.add_vertex(domain_vertex, codomain_vertex)
+        self.trail.append(('v', domain_vertex))
 
         # Unless the domain vertex is a boundary vertex, check that the number
         # of adjacent edges of the codomain vertex is the same as the number
         # for the domain vertex.
         # Because matchings are required to be injective on edges, this will
         # guarantee that the gluing conditions are satisfied.
-        if not self.domain.is_boundary(domain_vertex):
-            if (len(self.domain.in_edges(domain_vertex))
-               != len(self.codomain.in_edges(codomain_vertex))):
-                match_log('Vertex failed: in_edges cannot '
-                          + 'satisfy gluing conditions.')
+        if not domain_is_boundary:
+            if len(domain_data.in_edges) != len(codomain_data.in_edges):
+                if DEBUG_MATCH:
+                    match_log('Vertex failed: in_edges cannot '
+                              + 'satisfy gluing conditions.')
                 return False
-            if (len(self.domain.out_edges(domain_vertex))
-               != len(self.codomain.out_edges(codomain_vertex))):
-                match_log('Vertex failed: out_edges cannot '
-                          + 'satisfy gluing conditions.')
+            if len(domain_data.out_edges) != len(codomain_data.out_edges):
+                if DEBUG_MATCH:
+                    match_log('Vertex failed: out_edges cannot '
+                              + 'satisfy gluing conditions.')
                 return False
 
         # If a new consistent map is added that satisfies the gluing
         # conditions, we are successful.
-        match_log('Vertex success.')
+        if DEBUG_MATCH:
+            match_log('Vertex success.')
         return True
 
     def try_add_edge(self, domain_edge: int, codomain_edge: int) -> bool:
@@ -163,75 +385,79 @@ class Match:
 
         Returns:
             `True` if a consistent match is found mapping `domain_edge` to
-            `codomain_edge`, otherwise `False`.
+            `codomain_edge`, otherwise `False`. On failure, the match may
+            have been partially extended and should be rolled back with
+            :py:meth:`undo`.
         """
-        match_log(f'Trying to add edge {domain_edge} '
-                  + f'-> {codomain_edge} to match:')
-        match_log(str(self))
+        if DEBUG_MATCH:
+            match_log(f'Trying to add edge {domain_edge} '
+                      + f'-> {codomain_edge} to match:')
+            match_log(str(self))
 
         # Check the values of the domain and codomain edges match.
-        domain_value = self.domain.edge_data(domain_edge).value
-        codomain_value = self.codomain.edge_data(codomain_edge).value
+        domain_data = self.domain.edata[domain_edge]
+        codomain_data = self.codomain.edata[codomain_edge]
+        domain_value = domain_data.value
+        codomain_value = codomain_data.value
         if domain_value != codomain_value:
-            match_log(
-                f'Edge failed: values {domain_value} != {codomain_value}')
+            if DEBUG_MATCH:
+                match_log(
+                    f'Edge failed: values {domain_value} != {codomain_value}')
             return False
 
         # The edge map must be injective.
         if codomain_edge in self.edge_image:
-            match_log('Edge failed: the map would become non-injective.')
+            if DEBUG_MATCH:
+                match_log('Edge failed: the map would become non-injective.')
             return False
 
+        # Each endpoint that is already mapped needs to be consistent with
+        # this edge pairing. Check these first, before changing the match,
+        # since this is the most common way for an edge to fail.
+        # Pair up sources and targets separately, rather than concatenating
+        # the lists, which would allocate two new lists per attempt.
+        vertex_map = self.vertex_map
+        for domain_vertex, codomain_vertex in chain(
+                zip(domain_data.s, codomain_data.s),
+                zip(domain_data.t, codomain_data.t)):
+            if (domain_vertex in vertex_map
+               and vertex_map[domain_vertex] != codomain_vertex):
+                if DEBUG_MATCH:
+                    match_log('Edge failed: inconsistent with '
+                              + 'previously mapped vertex.')
+                return False
+
         # If the values match and the codomain edge has not already been
         # mapped to, map domain edge to codomain edge.
         self.edge_map[domain_edge] = codomain_edge
         self.edge_image.add(codomain_edge)
-
-        # Domain sources must match codomain sources and domain targets must
-        # match codomain targets.
-        preimg_edge_domain = self.domain.edge_domain(domain_edge)
-        image_edge_domain = self.codomain.edge_domain(codomain_edge)
-        if preimg_edge_domain != image_edge_domain:
-            match_log(f'Edge domain {preimg_edge_domain} does not '
-                      + f'match image domain {image_edge_domain}.')
-
-        preimg_edge_codomain = self.domain.edge_codomain(domain_edge)
-        image_edge_codomain = self.codomain.edge_codomain(codomain_edge)
-        if preimg_edge_codomain != image_edge_codomain:
-            match_log(f'Edge codomain {preimg_edge_codomain} does not '
-                      + f'match image codomain {image_edge_codomain}.')
-
-        # Check a vertex map consistent with this edge pairing exists.
-        domain_sources = self.domain.source(domain_edge)
-        codomain_sources = self.codomain.source(codomain_edge)
-        domain_targets = self.domain.target(domain_edge)
-        codomain_targets = self.codomain.target(codomain_edge)
-        vertices_to_check = zip(domain_sources + domain_targets,
-                                codomain_sources + codomain_targets)
-
-        for domain_vertex, codomain_vertex in vertices_to_check:
-            # Each vertex that is already mapped needs to be consistent.
-            if (domain_vertex in self.vertex_map
-               and self.vertex_map[domain_vertex] != codomain_vertex):
-                match_log(
-                    'Edge failed: inconsistent with previously mapped vertex.')
-                return False
-            # Otherwise, a consistent match must be found vertex for unmapped
-            # source and target vertices.
-            else:
-                if not self.try_add_vertex(domain_vertex, codomain_vertex):
+        self.trail.append(('e', domain_edge))
+
+        # A consistent match must then be found for the unmapped source and
+        # target vertices. Mapped ones were checked above and are accepted
+        # again by `try_add_vertex`, which also checks that each source and
+        # target has the same type and size as its image. So the domain and
+        # codomain of the edges match without comparing them separately.
+        try_add_vertex = self.try_add_vertex
+        for domain_vertex, codomain_vertex in chain(
+                zip(domain_data.s, codomain_data.s),
+                zip(domain_data.t, codomain_data.t)):
+            if not try_add_vertex(domain_vertex, codomain_vertex):
+                if DEBUG_MATCH:
                     match_log('Edge failed: couldn\'t '
                               + 'add a source or target vertex.')
-                    return False
+                return False
 
-        match_log('Edge success.')
+        if DEBUG_MATCH:
+            match_log('Edge success.')
         return True
 
     def domain_neighbourhood_mapped(self, vertex: int) -> bool:
         """Return whether all adjacent edges of a domain vertex are mapped."""
-        return (all(e in self.edge_map for e in self.domain.in_edges(vertex))
-                and
-                all(e in self.edge_map for e in self.domain.out_edges(vertex)))
+        edge_map = self.edge_map
+        vertex_data = self.domain.vdata[vertex]
+        return (all(e in edge_map for e in vertex_data.in_edges)
+                and all(e in edge_map for e in vertex_data.out_edges))
 
     # def cod_nhd_mapped(self, cod_v: int):
     #     """Returns True if nhd(cod_v) is the range of emap"""
@@ -243,17 +469,23 @@ class Match:
 
         Note that any matchings of scalars will yield isomorphic results under
         rewriting, so we don't return a list of all the possible matchings.
+        Instead, domain scalars are visited in edge order and each one is
+        sent to the first unused codomain scalar with the same value, which
+        fixes a single canonical assignment. Scalars have no endpoints, so
+        `more` never branches on them afterwards.
 
         Returns:
             `True` if all scalars in the domain are mapped injectively to
             scalars in the codomain, otherwise `False`.
         """
-        # Find all scalars in the codomain
-        codomain_scalars = []
-        for edge in self.codomain.edges():
+        # Find all scalars in the codomain, grouped by value. Each group is
+        # reversed so that popping from it yields the first scalar with that
+        # value.
+        codomain_scalars: dict[Any, list[int]] = dict()
+        for edge in reversed(list(self.codomain.edges())):
             edge_data = self.codomain.edge_data(edge)
             if len(edge_data.s) == 0 and len(edge_data.t) == 0:
-                codomain_scalars.append((edge, edge_data.value))
+                codomain_scalars.setdefault(edge_data.value, []).append(edge)
 
         # Greedily try to map scalar edges in the domain to scalar
         # edges in the codomain with the same value.
@@ -261,101 +493,132 @@ class Match:
             edge_data = self.domain.edge_data(edge)
             if len(edge_data.s) != 0 or len(edge_data.t) != 0:
                 continue
-            match_log(f'Trying to map scalar edge {edge}')
-            found_match = False
-            for i, (codomain_scalar, value) in enumerate(codomain_scalars):
-                if value == edge_data.value:
-                    # Map the domain scalar to the first codomain scalar
-                    # available with the same value.
-                    self.edge_map[edge] = codomain_scalar
-                    self.edge_image.add(codomain_scalar)
-                    found_match = True
-                    # Since the edge map must be injective, if a scalar in the
-                    # codomain is mapped to, remove it from the list of
-                    # candidates for future domain scalars to be mapped to.
-                    codomain_scalars.pop(i)
-                    match_log(f'Successfully mapped scalar {edge} '
-                              + f'-> {codomain_scalar}')
-                    break
-            if not found_match:
-                match_log(f'Match failed: could not map scalar edge {edge}.')
+            if DEBUG_MATCH:
+                match_log(f'Trying to map scalar edge {edge}')
+            candidates = codomain_scalars.get(edge_data.value)
+            if not candidates:
+                if DEBUG_MATCH:
+                    match_log('Match failed: could not map '
+                              + f'scalar edge {edge}.')
                 return False
+            # Map the domain scalar to the first codomain scalar available
+            # with the same value. Since the edge map must be injective,
+            # popping it removes it from the candidates for future domain
+            # scalars to be mapped to.
+            codomain_scalar = candidates.pop()
+            self.edge_map[edge] = codomain_scalar
+            self.edge_image.add(codomain_scalar)
+            self.trail.append(('e', edge))
+            if DEBUG_MATCH:
+                match_log(f'Successfully mapped scalar {edge} '
+                          + f'-> {codomain_scalar}')
 
         return True
 
-    def more(self) -> list[Match]:
-        """Return any matches extending `self` by a single vertex or edge."""
-        # A list of partial matches the same as this one,
-        # but matching 1 more vertex or edge.
-        extended_matches = []
-
-        # First, try to add an edge adjacent to any domain vertices
-        # that have already been matched.
-        for domain_vertex in self.vertex_map:
-            # If all the edges adjacent to the current vertex have
-            # already been matched, continue.
-            if self.domain_neighbourhood_mapped(domain_vertex):
-                continue
+    def more(self) -> Iterator[Match]:
+        """Extend `self` in place by a single vertex or edge, in every way.
 
-            # Otherwise, try to extend the match by mapping an edge
-            # adjacent to the current vertex into the codomain graph.
-            codomain_vertex = self.vertex_map[domain_vertex]
-
-            # Try to extend the match by mapping an adjacent source edge.
-            for edge in self.domain.in_edges(domain_vertex):
-                # If the edge has already been matched, continue.
-                if edge in self.edge_map:
-                    continue
-                # Otherwise, try to map this edge into the codomain graph.
-                for codomain_edge in self.codomain.in_edges(codomain_vertex):
-                    potential_new_match = self.copy()
-                    # If the edge is successfully mapped to an edge in the
-                    # codomain graph, extend the match with this mapping.
-                    if potential_new_match.try_add_edge(edge, codomain_edge):
-                        extended_matches.append(potential_new_match)
-                return extended_matches
-
-            # If there are no unmapped source edges, try to
-            # extend the match by mapping an adjacent target edge.
-            for edge in self.domain.out_edges(domain_vertex):
-                # If the edge has already been matched, continue.
-                if edge in self.edge_map:
-                    continue
-                # Otherwise, try to map this edge into the codomain graph.
-                for codomain_edge in self.codomain.out_edges(codomain_vertex):
-                    potential_new_match = self.copy()
-                    # If the edge is successfully mapped to an edge in the
-                    # codomain graph, extend the match with this mapping.
-                    if potential_new_match.try_add_edge(edge, codomain_edge):
-                        extended_matches.append(potential_new_match)
-                return extended_matches
+        Each time the returned iterator yields, `self` has been extended by
+        one more vertex or edge. The extension is undone again before the
+        iterator resumes, so once it is exhausted `self` is left as it was.
+        Candidates are tried in reverse order, as if popped from a stack.
+        """
+        # First, try to add an edge adjacent to any domain vertices that have
+        # already been matched. Of all such edges, branch on the one with the
+        # fewest codomain edges it could still be mapped to.
+        best_edge = -1
+        best_available: list[int] = []
+        edge_map = self.edge_map
+        domain_vdata = self.domain.vdata
+        codomain_vdata = self.codomain.vdata
+        available_edges = self.available_edges
+        for domain_vertex, codomain_vertex in self.vertex_map.items():
+            domain_data = domain_vdata[domain_vertex]
+            codomain_data = codomain_vdata[codomain_vertex]
+            # Consider mapping each adjacent source edge that has not been
+            # matched yet to a source edge of the image vertex, and each such
+            # target edge to a target edge.
+            for edge in domain_data.in_edges:
+                if edge not in edge_map:
+                    available = available_edges(edge, codomain_data.in_edges)
+                    if best_edge == -1 or len(available) < len(best_available):
+                        best_edge, best_available = edge, available
+            for edge in domain_data.out_edges:
+                if edge not in edge_map:
+                    available = available_edges(edge, codomain_data.out_edges)
+                    if best_edge == -1 or len(available) < len(best_available):
+                        best_edge, best_available = edge, available
+            # An edge that cannot be mapped anywhere means this match has no
+            # total extensions.
+            if best_edge != -1 and not best_available:
+                return
+
+        if best_edge != -1:
+            checkpoint = self.checkpoint()
+            for codomain_edge in reversed(best_available):
+                # If the edge is successfully mapped to an edge in the
+                # codomain graph, extend the match with this mapping.
+                if self.try_add_edge(best_edge, codomain_edge):
+                    yield self
+                self.undo(checkpoint)
+            return
 
         # If all domain edges adjacent to matched domain vertices have already
-        # been matched, try to match an unmatched domain vertex.
-        for domain_vertex in self.domain.vertices():
+        # been matched, try to match the most constrained unmatched domain
+        # vertex.
+        for domain_vertex in self.domain_vertex_order():
             # If the vertex has already been matched into the codomain graph,
             # continue. (Note we have looked at the edge-neighbourhood of
             # these vertices above)
             if domain_vertex in self.vertex_map:
                 continue
 
-            # Try to map the current domain vertex to any of the codomain
-            # vertices, extending the current match with this map when
-            # successful.
-            for codomain_vertex in self.codomain.vertices():
-                potential_new_match = self.copy()
-                if potential_new_match.try_add_vertex(domain_vertex,
-                                                      codomain_vertex):
-                    extended_matches.append(potential_new_match)
-            return extended_matches
-
-        # If no extended matches were found, return an empty list.
-        return []
+            # Try to map the current domain vertex to any of its candidate
+            # codomain vertices, extending the current match with this map
+            # when successful.
+            checkpoint = self.checkpoint()
+            for codomain_vertex in reversed(
+                    self.candidate_vertices(domain_vertex)):
+                if self.try_add_vertex(domain_vertex, codomain_vertex):
+                    yield self
+                self.undo(checkpoint)
+            return
+
+    def available_edges(self, edge: int,
+                        codomain_edges: Iterable[int]) -> list[int]:
+        """Return those of `codomain_edges` that `edge` could be mapped to.
+
+        These are the codomain edges that are candidates for `edge`, not
+        already in the image of the match, since the edge map is injective,
+        and whose sources and targets agree with the vertex map wherever the
+        sources and targets of `edge` are already mapped.
+        """
+        candidates = self.candidate_edges(edge)
+        edge_image = self.edge_image
+        vertex_map = self.vertex_map
+        edge_data = self.domain.edata[edge]
+        # The endpoints of `edge` that are already mapped, with their
+        # positions among the sources and targets.
+        mapped_sources = [(i, vertex_map[v]) for i, v in enumerate(edge_data.s)
+                          if v in vertex_map]
+        mapped_targets = [(i, vertex_map[v]) for i, v in enumerate(edge_data.t)
+                          if v in vertex_map]
+        codomain_edata = self.codomain.edata
+        available = []
+        for e in codomain_edges:
+            if e not in candidates or e in edge_image:
+                continue
+            codomain_data = codomain_edata[e]
+            if (all(codomain_data.s[i] == v for i, v in mapped_sources)
+               and all(codomain_data.t[i] == v for i, v in mapped_targets)):
+                available.append(e)
+        return available
 
     def is_total(self) -> bool:
         """Return whether all domain vertices and edges have been mapped."""
-        return (len(self.vertex_map) == self.domain.num_vertices()
-                and len(self.edge_map) == self.domain.num_edges())
+        # Only domain vertices and edges are ever mapped, so they are all
+        # mapped exactly when the two maps have this many keys in total.
+        return len(self.vertex_map) + len(self.edge_map) == self.domain_size
 
     def is_surjective(self) -> bool:
         """Return whether the vertex and edge maps are surjective."""
@@ -382,19 +645,24 @@ class Match:
         if not self.is_injective():
             return False
 
-        # Check that the image sub-hypergraph is convex.
-        # Get all successors of vertices in the image of the output
-        # of the domain graph.
-        output_image_successors = self.codomain.successors(
-            [self.vertex_map[v] for v in self.domain.outputs()
-             if v in self.vertex_map])
-        # Check there is no path from any vertices in the image of the domain
-        # outputs to a vertex in the image of the domain inputs.
-        for v in self.domain.inputs():
-            if (v in self.vertex_map
-               and self.vertex_map[v] in output_image_successors):
-                return False
-        return True
+        # Check that the image sub-hypergraph is convex, i.e. there is no path
+        # from any vertex in the image of the domain outputs to a vertex in
+        # the image of the domain inputs.
+        input_image = {self.vertex_map[v] for v in self.domain.inputs()
+                       if v in self.vertex_map}
+        if not input_image:
+            return True
+        # Many total matches found by one search share the same output image,
+        # so the successors of each output image are computed once and shared
+        # with copies of this match.
+        output_image = frozenset(self.vertex_map[v]
+                                 for v in self.domain.outputs()
+                                 if v in self.vertex_map)
+        successors = self.successor_cache.get(output_image)
+        if successors is None:
+            successors = self.codomain.successors(output_image)
+            self.successor_cache[output_image] = successors
+        return successors.isdisjoint(input_image)
 
 
 class Matches(Iterable):
@@ -403,13 +671,16 @@ class Matches(Iterable):
     This class can be used to iterate over total matches of a graph
     into another, optionally requiring these matches to be convex.
 
-    A class instance works by keeping a stack of partial or total matches.
-    When it is iterated over, it pops a match from its match stack if it is
-    non-empty, otherwise the iteration is stopped. If a match has been popped,
-    the instance returns the match if it is total (and convex if required).
-    Otherwise, the instance tries to extend the match and add any extended
-    matches to the stack, then continues this process of popping off the match
-    stack and extending if possible until a valid match is found and returned.
+    A class instance works by depth-first search on a single partial match,
+    which is extended in place and rolled back on backtracking, rather than
+    copied at every step. It keeps a stack of iterators, one per level of the
+    search, each produced by :py:meth:`Match.more`. When it is iterated over,
+    it advances the iterator at the top of the stack, popping it if it is
+    exhausted, otherwise the iteration is stopped once the stack is empty.
+    If the match has been extended, the instance returns a copy of the match
+    if it is total (and convex if required). Otherwise, it pushes an iterator
+    over further extensions of the match onto the stack, then continues this
+    process until a valid match is found and returned.
     """
     def __init__(self, domain: Graph, codomain: Graph,
                  initial_match: Match | None = None,
@@ -425,17 +696,24 @@ class Matches(Iterable):
             convex: Whether to only accept convex matches.
         """
         if initial_match is None:
-            initial_match = Match(domain=domain, codomain=codomain)
+            self.match = Match(domain=domain, codomain=codomain)
+        else:
+            self.match = initial_match.copy()
         self.convex = convex
-
-        # Try to map scalars on the initial match.
-        if initial_match.map_scalars():
-            self.match_stack = [initial_match]
-        # If the scalars could not be mapped, set the match
-        # stack to be empty. This means that not suitable matches
-        # will be found by this class instance.
+        # Convex matches are injective, so prune non-injective partial
+        # matches rather than leaving them to `is_convex` once total.
+        self.match.injective = convex
+
+        # Try to map scalars on the initial match, if the codomain is big
+        # enough to contain the domain at all.
+        self.stack: list[Iterator[Match]]
+        if self.match.has_room() and self.match.map_scalars():
+            self.stack = [iter([self.match])]
+        # If the scalars could not be mapped, set the stack to be empty.
+        # This means that not suitable matches will be found by this class
+        # instance.
         else:
-            self.match_stack = []
+            self.stack = []
 
     def __iter__(self) -> Iterator:
         """Return an iterator over matches of domain into codomain."""
@@ -447,27 +725,54 @@ class Matches(Iterable):
         A 'suitable' match is one that is total and, if `self.convex == True`,
         convex.
         """
-        while len(self.match_stack) > 0:
-            # Pop the match at the top of the match stack
-            m = self.match_stack.pop()
+        m = self.advance()
+        # If a suitable match was not found, stop the iteration.
+        if m is None:
+            raise StopIteration
+        return m.copy()
+
+    def advance(self) -> Match | None:
+        """Search for the next suitable match, without copying it.
+
+        The match returned is the one the search extends in place, so it is
+        only valid until the search is advanced again. Returns `None` once
+        there are no more suitable matches.
+        """
+        while len(self.stack) > 0:
+            # Extend the match in the next way allowed at the current level,
+            # or backtrack a level if there are no more ways to extend it.
+            m = next(self.stack[-1], None)
+            if m is None:
+                self.stack.pop()
             # If the match is total (and convex if required), return it.
-            if m.is_total():
-                match_log("got successful match:\n" + str(m))
+            elif m.is_total():
+                if DEBUG_MATCH:
+                    match_log("got successful match:\n" + str(m))
                 if self.convex:
                     if m.is_convex():
-                        match_log("match is convex, returning")
+                        if DEBUG_MATCH:
+                            match_log("match is convex, returning")
                         return m
                     else:
-                        match_log("match is not convex, dropping")
+                        if DEBUG_MATCH:
+                            match_log("match is not convex, dropping")
                 else:
                     return m
-            # If the match at the top of the match stack was not total
-            # (and convex if required), try to extend the match at the
-            # top of the stack and add the results to the match stack.
+            # If the match was not total (and convex if required), try to
+            # extend it further.
             else:
-                self.match_stack += m.more()
-        # If a suitable match was not found, stop the iteration.
-        raise StopIteration
+                self.stack.append(m.more())
+        return None
+
+    def count(self) -> int:
+        """Return the number of remaining suitable matches.
+
+        This exhausts the iterator, but does not copy any of the matches.
+        """
+        n = 0
+        while self.advance() is not None:
+            n += 1
+        return n
 
 
 def match_graph(domain: Graph, codomain: Graph,
@@ -476,6 +781,12 @@ def match_graph(domain: Graph, codomain: Graph,
     return Matches(domain, codomain, convex=convex)
 
 
+def count_matches(domain: Graph, codomain: Graph,
+                  convex: bool = True) -> int:
+    """Return the number of matches of domain into codomain."""
+    return Matches(domain, codomain, convex=convex).count()
+
+
 def match_rule(rule: Rule, graph: Graph,
                convex: bool = True) -> Iterable[Match]:
     """Return matches of the left side of `rule` into `graph`."""
@@ -496,6 +807,12 @@ def find_iso(domain_graph: Graph, codomain_graph: Graph) -> Match | None:
     if (domain_graph.domain() != codomain_graph.domain()
        or domain_graph.codomain() != codomain_graph.codomain()):
         return None
+    # The edge map of a surjective match is a bijection, and its vertex map
+    # can only be non-injective by identifying boundary vertices, so there is
+    # no point searching if the graphs have the wrong number of either.
+    if (domain_graph.num_edges() != codomain_graph.num_edges()
+       or domain_graph.num_vertices() < codomain_graph.num_vertices()):
+        return None
 
     # Try to find an initial match mapping one of the boundary vertices of the
     # domain graph to the corresponding boundary vertex (the vertex in the same
@@ -512,11 +829,15 @@ def find_iso(domain_graph: Graph, codomain_graph: Graph) -> Match | None:
             return None
 
     # If an initial match is found, try to find a total and surjective match
-    # of the domain graph into the codomain graph.
-    for match in Matches(domain=domain_graph, codomain=codomain_graph,
-                         initial_match=initial_match, convex=False):
+    # of the domain graph into the codomain graph. Only that match needs to
+    # be copied out of the search.
+    matches = Matches(domain=domain_graph, codomain=codomain_graph,
+                      initial_match=initial_match, convex=False)
+    match = matches.advance()
+    while match is not None:
         if match.is_surjective():
-            return match
+            return match.copy()
+        match = matches.advance()
 
     # If a total surjective match is not found, return `None`.
     return None
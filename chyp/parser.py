@@ -13,13 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os.path
-from typing import Dict, Optional, Tuple
+import os
+from functools import lru_cache
+from typing import Any, Optional
 from lark import Lark, UnexpectedInput, Tree
 
 from . import state
 
-GRAMMAR = Lark("""
+GRAMMAR_SOURCE = """
     start : statement*
     ?statement : import_statement | gen | let | def_statement | rule | rewrite | show | theorem_statement
     gen : "gen" var ":" type_term "->" type_term [ gen_color ]
@@ -74,29 +75,53 @@ GRAMMAR = Lark("""
     rule_ref : IDENT
     term_hole : term | "?" | LHS | RHS
     color : HEXDIGIT HEXDIGIT HEXDIGIT HEXDIGIT HEXDIGIT HEXDIGIT
-    IDENT: ("_"|LETTER) ("_"|"."|LETTER|DIGIT)*
+    IDENT: /[A-Za-z_][A-Za-z0-9_.]*/
     TACTIC_ARG: /[^(),]+/
 
-    %import common.LETTER
-    %import common.DIGIT
     %import common.HEXDIGIT
     %import common.INT
     %import common.WS
     %import common.SH_COMMENT
     %ignore WS
     %ignore SH_COMMENT
-    """,
-    parser='lalr',
-    propagate_positions=True,
-    maybe_placeholders=True)
-
-
-# cache parse trees for imported files and only re-parse if the file changes
-parse_cache: Dict[str, Tuple[float, Tree]] = dict()
+    """
+
+# the grammar is only built when something is first parsed, so importing this module
+# (e.g. on GUI startup) is cheap
+@lru_cache(maxsize=None)
+def grammar() -> Lark:
+    # Lark stores the compiled parser in the temp directory, keyed on a hash of the
+    # grammar and options, so later processes load it instead of rebuilding the LALR
+    # tables.
+    return Lark(GRAMMAR_SOURCE,
+                parser='lalr',
+                propagate_positions=True,
+                maybe_placeholders=True,
+                cache=True)
+
+def __getattr__(name: str) -> Any:
+    # keep GRAMMAR available as a module attribute, built on first access
+    if name == 'GRAMMAR':
+        return grammar()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+# cache parse trees for imported files and only re-parse if the file changes. The
+# size is part of the key to catch edits within the resolution of the mtime, and the
+# cache is bounded so trees of files that are no longer imported are dropped.
+@lru_cache(maxsize=128)
+def parse_file(file_name: str, mtime: float, size: int) -> Tree:
+    with open(file_name) as f:
+        return grammar().parse(f.read())
+
+# likewise cache parse trees of recently parsed code, e.g. when the editor re-checks a
+# document, or an edit is undone, without the text changing. Transforming a tree does
+# not modify it, so cached trees can be transformed any number of times.
+@lru_cache(maxsize=16)
+def parse_code(code: str) -> Tree:
+    return grammar().parse(code)
 
 def parse(code: str='', file_name: str='', namespace: str='', parent: Optional[state.State] = None) -> state.State:
-    global parse_cache
-
     old_namespace = ''
     if parent:
         old_namespace = parent.namespace
@@ -122,15 +147,10 @@ def parse(code: str='', file_name: str='', namespace: str='', parent: Optional[s
 
     try:
         if file_name and not code:
-            mtime = os.path.getmtime(file_name)
-            if file_name in parse_cache and parse_cache[file_name][0] == mtime:
-                tree = parse_cache[file_name][1]
-            else:
-                with open(file_name) as f:
-                    tree = GRAMMAR.parse(f.read())
-                parse_cache[file_name] = (mtime, tree)
+            st = os.stat(file_name)
+            tree = parse_file(file_name, st.st_mtime, st.st_size)
         else:
-            tree = GRAMMAR.parse(code)
+            tree = parse_code(code)
         parse_data.transform(tree)
     except UnexpectedInput as e:
         msg = 'Parse error: '
@@ -15,6 +15,10 @@ class Part:
     VALID = 2
     INVALID = 3
 
+    # documents are re-parsed on every edit and produce one Part per statement and
+    # proof step, so avoid a __dict__ per instance
+    __slots__ = ('start', 'end', 'line', 'name', 'status', 'layed_out', 'index')
+
     start: int
     end: int
     line: int
@@ -33,15 +37,17 @@ class Part:
         self.index = -1
 
 class GraphPart(Part):
+    __slots__ = ('graph',)
     graph: Graph
     def __init__(self, start: int, end: int, line: int, name: str, graph: Graph):
         Part.__init__(self, start, end, line, name)
         self.graph = graph
 
-class LetPart(GraphPart): pass
-class GenPart(GraphPart): pass
+class LetPart(GraphPart): __slots__ = ()
+class GenPart(GraphPart): __slots__ = ()
 
 class TwoGraphPart(Part):
+    __slots__ = ('lhs', 'rhs')
     lhs: Optional[Graph]
     rhs: Optional[Graph]
     def __init__(self, start: int, end: int, line: int, name: str, lhs: Optional[Graph]=None, rhs: Optional[Graph]=None):
@@ -50,12 +56,14 @@ class TwoGraphPart(Part):
         self.rhs = rhs
 
 class RulePart(TwoGraphPart):
+    __slots__ = ('rule',)
     rule: Rule
     def __init__(self, start: int, end: int, line: int, rule: Rule):
         TwoGraphPart.__init__(self, start, end, line, rule.name, rule.lhs, rule.rhs)
         self.rule = rule
 
 class TheoremPart(TwoGraphPart):
+    __slots__ = ('sequence', 'formula')
     sequence: int
     formula: Rule
     def __init__(self,
@@ -69,6 +77,7 @@ class TheoremPart(TwoGraphPart):
         self.formula = formula
 
 class ProofStepPart(TwoGraphPart):
+    __slots__ = ('sequence', 'proof_state')
     sequence: int
     proof_state: Optional[ProofState]
     def __init__(self,
@@ -83,10 +92,11 @@ class ProofStepPart(TwoGraphPart):
         self.proof_state = None
         self.sequence = sequence
 
-class ProofStartPart(ProofStepPart): pass
-class ProofQedPart(ProofStepPart): pass
+class ProofStartPart(ProofStepPart): __slots__ = ()
+class ProofQedPart(ProofStepPart): __slots__ = ()
 
 class ApplyTacticPart(ProofStepPart):
+    __slots__ = ('tactic', 'tactic_args')
     tactic: str
     tactic_args: List[str]
     def __init__(self,
@@ -102,6 +112,7 @@ class ApplyTacticPart(ProofStepPart):
         self.tactic_args = [] if tactic_args is None else tactic_args
 
 class RewritePart(ProofStepPart):
+    __slots__ = ('tactic', 'tactic_args', 'lhs_side', 'rhs_side', 'stub', 'term_pos')
     tactic: str
     tactic_args: List[str]
     lhs_side: Optional[Literal['LHS', 'RHS']]
@@ -130,6 +141,6 @@ class RewritePart(ProofStepPart):
         self.rhs_side = rhs_side
         self.stub = stub
 
-class ImportPart(Part): pass
+class ImportPart(Part): __slots__ = ()
 
 
@@ -1,12 +1,15 @@
 from __future__ import annotations
 import re
-from typing import Dict, Iterator, List, Optional, Set, Tuple
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Set, Tuple
 from .graph import Graph
 from .rewrite import dpo
 from .rule import Rule, RuleError
 from .matcher import Match, match_rule, find_iso
 from . import state
 
+if TYPE_CHECKING:
+    from .parts import ProofStepPart
+
 RULE_NAME_RE = re.compile('(-)?\\s*([a-zA-Z_][\\.a-zA-Z0-9_]*)')
 
 class Goal:
@@ -47,7 +50,7 @@ class ProofState:
         ps.errors = errors
         return ps
     
-    def snapshot(self, part: state.ProofStepPart) -> ProofState:
+    def snapshot(self, part: ProofStepPart) -> ProofState:
         goals = [g.copy() for g in self.goals]
         ps = ProofState(self.state, self.sequence, goals)
         ps.line = part.line
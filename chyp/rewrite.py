@@ -81,8 +81,7 @@ def dpo(r: Rule, m: Match) -> Iterable[Match]:
             v1 = h.add_vertex(
                 vtype=vd.vtype, size=vd.size,
                 x=vd.x, y=vd.y, value=vd.value)
-            m1.vertex_map[v] = v1
-            m1.vertex_image.add(v1)
+            m1.add_vertex(v, v1)
 
     # now add the edges from rhs to h and connect them using vmap1
     for e in r.rhs.edges():
@@ -16,6 +16,8 @@
 from __future__ import annotations
 
 import os.path
+import sys
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 import lark
 from lark import v_args
@@ -25,7 +27,12 @@ from . import parser
 from .graph import Graph, GraphError, gen, perm, identity, redistributer
 from .rule import Rule, RuleError
 from .proofstate import ProofState
-from .parts import *
+from .parts import (Part, GenPart, LetPart, RulePart, TheoremPart, ImportPart, RewritePart,
+                    ProofStartPart, ProofQedPart, ApplyTacticPart)
+
+# the built-in 'refl' rule is the same empty rule for every State, so it is shared
+# rather than rebuilt for each parse
+REFL_RULE = Rule(Graph(), Graph(), name="refl")
 
 
 class State(lark.Transformer):
@@ -36,7 +43,7 @@ class State(lark.Transformer):
         self.import_depth = 0
         self.sequence: int = 0
         self.graphs: Dict[str, Graph] = dict()
-        self.rules: Dict[str, Rule] = {'refl': Rule(Graph(), Graph(), name="refl")}
+        self.rules: Dict[str, Rule] = {'refl': REFL_RULE}
         self.rule_sequence: Dict[str, int] = {'refl': 0}
         # self.rewrites: Dict[str, List[RewriteState]] = dict()
         self.proofs: Dict[str, ProofState] = dict()
@@ -44,6 +51,17 @@ class State(lark.Transformer):
         self.parts: List[Part] = list()
         self.current_part: Optional[Part] = None
         self.parsed = False
+
+    # the namespace changes while imports are parsed, so keep the prefix for qualified
+    # names in step with it rather than rebuilding it for every name
+    @property
+    def namespace(self) -> str:
+        return self._namespace
+
+    @namespace.setter
+    def namespace(self, namespace: str) -> None:
+        self._namespace = namespace
+        self.ns_prefix = namespace + '.' if namespace else ''
     
     def set_current_part(self, p: Optional[Part]) -> None:
         self.current_part = p
@@ -80,9 +98,10 @@ class State(lark.Transformer):
             else:
                 break
 
+    # names are interned, as they are used over and over as keys into self.graphs and
+    # self.rules
     def var(self, items: List[Any]) -> str:
-        s = str(items[0])
-        return self.namespace + '.' + s if self.namespace else s
+        return sys.intern(self.ns_prefix + str(items[0]))
 
     def module_name(self, items: List[Any]) -> str:
         return str(items[0])
@@ -188,37 +207,34 @@ class State(lark.Transformer):
 
     @v_args(meta=True)
     def term_ref(self, meta: Meta, items: List[Any]) -> Optional[Graph]:
-        s = str(items[0])
-        if self.namespace:
-            s = self.namespace + '.' + s
+        s = sys.intern(self.ns_prefix + str(items[0]))
 
-        if s in self.graphs:
-            return self.graphs[s]
-        else:
+        g = self.graphs.get(s)
+        if g is None:
             self.errors.append((self.file_name, meta.line, 'Undefined term: ' + s))
-            return None
+        return g
 
     @v_args(meta=True)
     def rule_ref(self, meta: Meta, items: List[Any]) -> Optional[Rule]:
         s = str(items[0])
-        if self.namespace and s != 'refl':
-            s = self.namespace + '.' + s
+        if s != 'refl':
+            s = self.ns_prefix + s
+        s = sys.intern(s)
 
-        if s in self.rules:
-            return self.rules[s]
-        else:
+        rule = self.rules.get(s)
+        if rule is None:
             self.errors.append((self.file_name, meta.line, 'Undefined rule: ' + s))
-            return None
+        return rule
 
     def par(self, items: List[Any]) -> Optional[Graph]:
-        if items[0] and items[1]:
+        if items[0] is not None and items[1] is not None:
             return items[0] * items[1]
         else:
             return None
 
     @v_args(meta=True)
     def seq(self, meta: Meta, items: List[Any]) -> Optional[Graph]:
-        if items[0] and items[1]:
+        if items[0] is not None and items[1] is not None:
             g = None
             try:
                 g = items[0] >> items[1]
@@ -240,11 +256,11 @@ class State(lark.Transformer):
         domain = items[1]
         codomain = items[2]
         (fg, bg) = items[3] if items[3] else ('', '')
-        if name not in self.graphs:
+        g = self.graphs.get(name)
+        if g is None:
             g = gen(name, domain, codomain, fg=fg, bg=bg)
             self.graphs[name] = g
         else:
-            g = self.graphs[name]
             existing_domain = g.domain()
             existing_codomain = g.codomain()
             if existing_domain != domain or existing_codomain != codomain:
@@ -294,7 +310,8 @@ class State(lark.Transformer):
                 domain = graph.domain()
                 codomain = graph.codomain()
 
-                if name not in self.graphs:
+                lhs = self.graphs.get(name)
+                if lhs is None:
                     lhs = gen(name, domain, codomain, fg=fg, bg=bg)
                     self.graphs[name] = lhs
                     rule = Rule(lhs, graph, rule_name)
@@ -302,7 +319,6 @@ class State(lark.Transformer):
                     self.rule_sequence[rule_name] = self.sequence
                     self.add_part(RulePart(meta.start_pos, meta.end_pos, meta.line, rule))
                 else:
-                    lhs = self.graphs[name]
                     lhs_domain = lhs.domain()
                     lhs_codomain = lhs.codomain()
                     if lhs_domain == domain and lhs_codomain == codomain:
@@ -326,7 +342,8 @@ class State(lark.Transformer):
         return (items[1], items[0]) if len(items) == 2 else ('', items[0])
 
     def color(self, items: List[Any]) -> str:
-        return '#' + ''.join([str(it) for it in items])
+        # the items are HEXDIGIT tokens, which are already strings
+        return '#' + ''.join(items)
 
     @v_args(meta=True)
     def import_statement(self, meta: Meta, items: List[Any]) -> None:
@@ -337,7 +354,7 @@ class State(lark.Transformer):
         for il in import_lets:
             if il:
                 name, graph = il
-                name = namespace + '.' + name
+                name = sys.intern(f'{namespace}.{name}')
                 if not name in self.graphs:
                     if graph:
                         self.graphs[name] = graph
@@ -392,7 +409,7 @@ class State(lark.Transformer):
                                               rhs=rhs))
                     lhs = rhs.copy() if rhs else None
                 start = end
-            if term and rhs and isinstance(rhs, Graph):
+            if term is not None and isinstance(rhs, Graph):
                 try:
                     if converse:
                         # TODO non-invertible rules
@@ -506,5 +523,7 @@ class State(lark.Transformer):
         return items[1]
 
 
+# the same modules are imported from the same files every time a document is re-parsed
+@lru_cache(maxsize=1024)
 def module_filename(name: str, current_file: str) -> str:
     return os.path.join(os.path.dirname(current_file), *name.split('.')) + '.chyp'